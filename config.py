@@ -9,5 +9,7 @@ class AttrDict(dict):
 
 try:
     config = toml.load('config.toml', AttrDict)
+    # we only need membership checks on this
+    config.telegram.admins = frozenset(config.telegram.admins)
 except FileNotFoundError:
     print("Please rename 'config.example.toml' to 'config.toml' and change the relevant values")
@@ -1,28 +1,47 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Message
 
 from emojis import Emoji
 from config import config
 
+# these buttons never change, so there's no need to build them every time we need a keyboard
+CANCEL_BUTTON = InlineKeyboardButton(f"{Emoji.CROSS} cancel", callback_data=f"cancel")
+LEAVE_BUTTON = InlineKeyboardButton(f"{Emoji.FREEZE} leave", callback_data=f"leave")
+START_BUTTON = InlineKeyboardButton(f"{Emoji.SANTA} start match", callback_data=f"match")
 
-def secret_santa(chat_id: int, bot_username: str, participants_count: int = 0):
+REVOKE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.CROSS} revoke", callback_data=f"revoke")]])
+NEW_SANTA_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.TREE} new Secret Santa", callback_data=f"newsanta")]])
+
+
+@lru_cache(maxsize=4096)
+def secret_santa_markup(chat_id: int, bot_username: str, leave_button: bool, start_button: bool):
     # knowing the message id is not really needed because a caht can only have one ongoing secret chat
     deeplink_url = f"https://t.me/{bot_username}?start={chat_id}"
     keyboard = [
         [InlineKeyboardButton(f"{Emoji.LIST} join", url=deeplink_url)],
-        [InlineKeyboardButton(f"{Emoji.CROSS} cancel", callback_data=f"cancel")],
+        [CANCEL_BUTTON],
     ]
 
-    if participants_count:
-        unsubscribe_button = InlineKeyboardButton(f"{Emoji.FREEZE} leave", callback_data=f"leave")
-        keyboard[0].append(unsubscribe_button)
+    if leave_button:
+        keyboard[0].append(LEAVE_BUTTON)
 
-    if participants_count >= config.santa.min_participants:
-        start_button = InlineKeyboardButton(f"{Emoji.SANTA} start match", callback_data=f"match")
-        keyboard[1].append(start_button)
+    if start_button:
+        keyboard[1].append(START_BUTTON)
 
     return InlineKeyboardMarkup(keyboard)
 
 
+def secret_santa(chat_id: int, bot_username: str, participants_count: int = 0):
+    # there are only three possible keyboards per chat: the cache key is the state, not the participants count
+    return secret_santa_markup(
+        chat_id,
+        bot_username,
+        leave_button=participants_count > 0,
+        start_button=participants_count >= config.santa.min_participants
+    )
+
+
 def joined_message(chat_id: int):
     return InlineKeyboardMarkup(
         [[
@@ -32,10 +51,16 @@ def joined_message(chat_id: int):
     )
 
 
+def resend_match(santa_message_id: int):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"{Emoji.PRESENT} get your match", callback_data=f"resendmatch:{santa_message_id}")
+    ]])
+
+
 def revoke():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.CROSS} revoke", callback_data=f"revoke")]])
+    return REVOKE_MARKUP
 
 
 def new_santa():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.TREE} new Secret Santa", callback_data=f"newsanta")]])
+    return NEW_SANTA_MARKUP
 
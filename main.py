@@ -1,21 +1,20 @@
 import datetime
-import itertools
+import hashlib
+import heapq
 import json
 import logging
 import logging.config
 import os
-import random
 import re
 import threading
 import time
-from functools import wraps
-from pathlib import Path
-from random import choice
-from typing import List, Callable, Optional, Union
-
-from telegram import Update, TelegramError, Chat, ParseMode, Bot, BotCommandScopeAllPrivateChats, BotCommand, User, \
-    BotCommandScopeAllChatAdministrators, ChatAction, ChatMemberLeft, ChatMemberUpdated, ChatMemberMember, \
-    BotCommandScopeChatAdministrators, ChatMember
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
+from typing import Optional, Union
+
+from telegram import Update, TelegramError, Chat, ParseMode, Bot, BotCommandScopeAllPrivateChats, BotCommand, \
+    BotCommandScopeAllChatAdministrators, ChatAction, ChatMemberUpdated, BotCommandScopeChatAdministrators, ChatMember
 from telegram.error import BadRequest
 from telegram.ext import Updater, CallbackContext, Filters, MessageHandler, CallbackQueryHandler, MessageFilter, \
     CommandHandler, ExtBot, Defaults, ChatMemberHandler
@@ -26,7 +25,6 @@ import utilities
 from emojis import Emoji
 from santa import SecretSanta
 from santa import NAME_MAX_LENGTH
-from mwt import MWT
 from config import config
 
 ACTIVE_SECRET_SANTA_KEY = "active_secret_santa"
@@ -35,8 +33,16 @@ REMOVED_KEY = "removed"
 BLOCKED_KEY = "blocked"
 RECENTLY_LEFT_KEY = "recently_left"
 RECENTLY_STARTED_SANTAS_KEY = "recently_closed_santas"
+ADMIN_IDS_KEY = "admin_ids"
+
+JOIN_DEEPLINK_REGEX = re.compile(r"^/start (-?\d+)")
 
 EMPTY_SECRET_SANTA_STR = f'{Emoji.SANTA}{Emoji.TREE} Nobody joined this Secret Santa yet! Use the "<b>join</b>" button below to join'
+CLOSED_SECRET_SANTA_STR = f'{Emoji.HOURGLASS} This Secret Santa has been closed. Participants list:\n\n{{participants}}'
+NEW_GROUP_STR = f"Hello everyone! I'm a bot that helps group chats to organize their " \
+                f"Secret Santas {Emoji.SANTA}{Emoji.SHH}\n" \
+                f"Anyone can use the button below to start a new one. Alternatively, the <code>/newsanta</code> " \
+                f"command can be used"
 
 
 class Time:
@@ -71,32 +77,72 @@ class Commands:
     ]
 
 
+REQUESTS_EXECUTOR_WORKERS = 8
+
 updater = Updater(
     bot=ExtBot(
         token=config.telegram.token,
-        defaults=Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True),
+        # run_async: handlers are executed by the dispatcher's workers, so the dispatcher thread can keep fetching
+        # updates while a callback is waiting for Telegram to answer. Updates for the same secret santa are still
+        # processed one at a time, see santa_lock()
+        defaults=Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True, run_async=True),
         # https://github.com/python-telegram-bot/python-telegram-bot/blob/8531a7a40c322e3b06eb943325e819b37ee542e7/telegram/ext/updater.py#L267
-        request=Request(con_pool_size=config.telegram.get('workers', 1) + 4)
+        # plus one connection for each thread of requests_executor
+        request=Request(con_pool_size=config.telegram.get('workers', 4) + 4 + REQUESTS_EXECUTOR_WORKERS)
     ),
-    workers=0,
+    workers=config.telegram.get('workers', 4),
     persistence=utilities.persistence_object()
 )
 
 BOT_LINK = f"https://t.me/{updater.bot.username}"
+BOT_ID = updater.bot.id
+
+# (expiration datetime, chat_id) of every active secret santa, so the cleanup job doesn't have to go through every chat
+santas_expiry_heap = []
+santas_expiry_heap_lock = threading.Lock()
+
+# one lock for each chat with a secret santa: handlers run concurrently, and two updates using the same secret santa
+# (eg. two taps on "start match", or a join while the matches are being sent) must not interleave.
+# Locks are only kept while some thread is using them: chat ids might come from users (eg. /start deeplinks)
+santa_locks = weakref.WeakValueDictionary()
+santa_locks_lock = threading.Lock()
+
+# used to run independent requests (eg. one per participant) concurrently instead of one after the other
+requests_executor = ThreadPoolExecutor(max_workers=REQUESTS_EXECUTOR_WORKERS)
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+requests_rate_limiter = utilities.RateLimiter(max_calls=30, period=1)
+
+
+def santa_lock(santa_chat_id: int):
+    with santa_locks_lock:
+        lock = santa_locks.get(santa_chat_id)
+        if lock is None:
+            lock = santa_locks[santa_chat_id] = threading.RLock()
+
+        return lock
 
 
 class NewGroup(MessageFilter):
     def filter(self, message):
-        if message.new_chat_members:
-            member: User
-            for member in message.new_chat_members:
-                if member.id == updater.bot.id:
-                    return True
+        return bool(message.new_chat_members) and any(member.id == BOT_ID for member in message.new_chat_members)
 
 
-def load_logging_config(file_name='logging.json'):
+class GroupChat(MessageFilter):
+    # a single check instead of the Filters.chat_type.groups merged filter
+    def filter(self, message):
+        chat_type = message.chat.type
+        return chat_type == Chat.GROUP or chat_type == Chat.SUPERGROUP
+
+
+@lru_cache(maxsize=1)
+def read_logging_config(file_name: str, mtime: float):
+    # mtime is part of the cache key, so the file is parsed again only if it changed
     with open(file_name, 'r') as f:
-        logging_config = json.load(f)
+        return json.load(f)
+
+
+def load_logging_config(file_name='logging.json'):
+    logging_config = read_logging_config(file_name, os.path.getmtime(file_name))
 
     logging.config.dictConfig(logging_config)
 
@@ -106,9 +152,33 @@ load_logging_config("logging.json")
 logger = logging.getLogger(__name__)
 
 
-@MWT(timeout=60 * 60)
+ADMIN_IDS_CACHE_TIMEOUT = Time.HOUR_1
+
+
+@lru_cache(maxsize=1024)
+def fetch_admin_ids(bot: Bot, chat_id: int, time_bucket: int):
+    # time_bucket is part of the cache key: it changes every ADMIN_IDS_CACHE_TIMEOUT seconds,
+    # so cached results expire on their own
+
+    # the administrators are also saved in bot_data as (timestamp, admin ids), so after a restart we don't have
+    # to request them again for every chat
+    saved_admin_ids = updater.dispatcher.bot_data.setdefault(ADMIN_IDS_KEY, {})
+
+    # the saved copy expires with the bucket too: if it was fetched during a previous bucket, using it would
+    # keep it cached for this whole bucket as well
+    saved = saved_admin_ids.get(chat_id)
+    if saved and saved[0] >= time_bucket * ADMIN_IDS_CACHE_TIMEOUT:
+        return saved[1]
+
+    admin_ids = frozenset(admin.user.id for admin in bot.get_chat_administrators(chat_id))
+    saved_admin_ids[chat_id] = (time.time(), admin_ids)
+
+    return admin_ids
+
+
 def get_admin_ids(bot: Bot, chat_id: int):
-    return [admin.user.id for admin in bot.get_chat_administrators(chat_id)]
+    # wall clock time, so buckets can be compared with the timestamps saved in bot_data before a restart
+    return fetch_admin_ids(bot, chat_id, int(time.time() // ADMIN_IDS_CACHE_TIMEOUT))
 
 
 def administrators(func):
@@ -182,6 +252,11 @@ def bot_restricted_check():
 
 def fail_with_message(answer_to_message=True):
     def real_decorator(func):
+        if not answer_to_message:
+            # nothing to answer: exceptions are logged by on_error, the dispatcher's error handler, so we
+            # can avoid wrapping the callback
+            return func
+
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
             try:
@@ -203,6 +278,37 @@ def fail_with_message(answer_to_message=True):
     return real_decorator
 
 
+def on_error(update: Optional[object], context: CallbackContext):
+    error_str = str(context.error)
+
+    if not isinstance(update, Update):
+        # eg. network errors while fetching updates: they are not related to any callback, and sending them
+        # to the log chat would most likely fail as well
+        logger.error('error while processing updates: %s', error_str, exc_info=context.error)
+        return
+
+    logger.error('error while running callback: %s', error_str, exc_info=context.error)
+
+    # callbacks processed by this handler are not wrapped by fail_with_message(): tell where the error comes from
+    if update.callback_query:
+        callback_data = update.callback_query.data
+        callback_name = GROUP_BUTTONS[callback_data].__name__ if callback_data in GROUP_BUTTONS else "callback"
+        origin = f"<code>{callback_name}()</code> (button <code>{utilities.escape(str(callback_data))}</code>)"
+    elif update.effective_message and update.effective_message.text:
+        origin = f"callback (message <code>{utilities.escape(update.effective_message.text[:64])}</code>)"
+    else:
+        origin = "callback"
+
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    error_str_message = f"Error during {origin} execution in chat <code>{chat_id}</code>: " \
+                        f"<code>{utilities.escape(error_str)}</code>"
+    if config.telegram.log_chat:
+        try:
+            context.bot.send_message(config.telegram.log_chat, f"#{context.bot.username} {error_str_message}")
+        except (TelegramError, BadRequest) as e:
+            logger.error("error while sending the error to the log chat: %s", e)
+
+
 def fail_with_message_job(func):
     @wraps(func)
     def wrapped(context: CallbackContext, *args, **kwargs):
@@ -223,45 +329,50 @@ def get_secret_santa():
     def real_decorator(func):
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
-
-            santa = None
             if update.effective_chat.id < 0:
-                logger.debug("searching for an active secret santa in %d's chat_data...", update.effective_chat.id)
-                if ACTIVE_SECRET_SANTA_KEY in context.chat_data:
-                    santa = SecretSanta.from_dict(context.chat_data[ACTIVE_SECRET_SANTA_KEY])
+                santa_chat_id = update.effective_chat.id
+            elif update.callback_query:
+                # private chat's inline button
+                santa_chat_id = private_button_chat_id(update)
             else:
-                # private chat
-                if update.callback_query:
-                    # private chat's inline button
-                    santa_chat_id = int(context.matches[0].group(1))
+                # deeplink
+                santa_chat_id = int(context.matches[0].group(1))
+
+            with santa_lock(santa_chat_id):
+                santa = None
+                if update.effective_chat.id < 0:
+                    logger.debug("searching for an active secret santa in %d's chat_data...", santa_chat_id)
+                    if ACTIVE_SECRET_SANTA_KEY in context.chat_data:
+                        santa = SecretSanta.from_dict(context.chat_data[ACTIVE_SECRET_SANTA_KEY])
                 else:
-                    # deeplink
-                    santa_chat_id = int(context.matches[0].group(1))
-
-                logger.debug("searching for an active secret santa for %d in the dispatcher...", santa_chat_id)
-                santa = find_santa_by_chat_id(context.dispatcher.chat_data, santa_chat_id)
-
-            result_santa = func(update, context, santa, *args, **kwargs)
-            if result_santa and isinstance(result_santa, SecretSanta):
-                logger.debug("saving returned SecretSanta object for chat %d...", result_santa.chat_id)
-                context.chat_data[ACTIVE_SECRET_SANTA_KEY] = result_santa.dict()
+                    # private chat
+                    logger.debug("searching for an active secret santa for %d in the dispatcher...", santa_chat_id)
+                    santa = find_santa_by_chat_id(context.dispatcher.chat_data, santa_chat_id)
+
+                result_santa = func(update, context, santa, *args, **kwargs)
+                if result_santa and isinstance(result_santa, SecretSanta):
+                    # existing secret santas are views over their chat_data dict and are edited in place:
+                    # we only need to save new ones
+                    santa_chat_data = context.dispatcher.chat_data[result_santa.chat_id]
+                    if santa_chat_data.get(ACTIVE_SECRET_SANTA_KEY) is not result_santa.dict():
+                        logger.debug("saving returned SecretSanta object for chat %d...", result_santa.chat_id)
+                        santa_chat_data[ACTIVE_SECRET_SANTA_KEY] = result_santa.dict()
 
         return wrapped
     return real_decorator
 
 
 def gen_participants_list(participants: dict, join_by: Optional[str] = None):
-    participants_list = []
-    i = 1
-    for participant_id, participant in participants.items():
-        string = f'<b>{i}</b>. {utilities.mention_escaped_by_id(participant_id, participant["name"])}'
-        participants_list.append(string)
-        i += 1
+    mention_escaped_by_id = utilities.mention_escaped_by_id
+    participants_lines = (
+        f'<b>{i}</b>. {mention_escaped_by_id(participant_id, participant["name"])}'
+        for i, (participant_id, participant) in enumerate(participants.items(), start=1)
+    )
 
     if isinstance(join_by, str):
-        return join_by.join(participants_list)
+        return join_by.join(participants_lines)
 
-    return participants_list
+    return list(participants_lines)
 
 
 def cancel_because_cant_send_messages(context: CallbackContext, santa: SecretSanta):
@@ -279,6 +390,16 @@ def cancel_because_cant_send_messages(context: CallbackContext, santa: SecretSan
 
 
 def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
+    # the message (text and keyboard) only depends on these: if they didn't change since the last edit,
+    # there's no need to build the text and the edit would fail anyway because the message would not be modified
+    message_state = (santa.started, tuple((user_id, user_data["name"]) for user_id, user_data in santa.participants.items()))
+    # the hash is saved in the santa dict: hash() can't be used because its value for strings changes every
+    # time the bot is restarted
+    message_hash = hashlib.blake2b(repr(message_state).encode(), digest_size=16).hexdigest()
+    if message_hash == santa.message_hash:
+        logger.debug("secret santa message (%d, %d) not modified: skipping edit", santa.chat_id, santa.santa_message_id)
+        return
+
     participants_count = santa.get_participants_count()
     if not participants_count:
         text = EMPTY_SECRET_SANTA_STR
@@ -288,37 +409,24 @@ def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
             participants_count=participants_count
         )
     elif santa.started:
-        participants_list = gen_participants_list(santa.participants)
-
-        base_text = '{santa} This Secret Santa has been started and everyone ' \
-                    '<a href="{bot_link}">received their match</a>!\n' \
-                    'Participants list:\n\n' \
-                    '{participants}'
-
-        text = base_text.format(
-            santa=Emoji.SANTA,
-            bot_link=BOT_LINK,
-            participants="\n".join(participants_list),
-            creator=santa.creator_name_escaped,
-        )
+        participants_list = gen_participants_list(santa.participants, join_by="\n")
+
+        text = f'{Emoji.SANTA} This Secret Santa has been started and everyone ' \
+               f'<a href="{BOT_LINK}">received their match</a>!\n' \
+               f'Participants list:\n\n' \
+               f'{participants_list}'
         reply_markup = None
     else:
-        participants_list = gen_participants_list(santa.participants)
+        participants_list = gen_participants_list(santa.participants, join_by="\n")
 
         min_participants_text = ""
-        if santa.get_missing_count() > 0:
-            min_participants_text = f". Other <b>{santa.get_missing_count()}</b> people are needed to start it"
-
-        base_text = '{santa} Oh-oh! A new Secret Santa!\nParticipants list:\n\n{participants}\n\n' \
-                    'To join, use the "<b>join</b>" button below and then tap on "<b>start </b>".\n' \
-                    'Only {creator} can start this Secret Santa{min_participants}'
-
-        text = base_text.format(
-            santa=Emoji.SANTA,
-            participants="\n".join(participants_list),
-            creator=santa.creator_name_escaped,
-            min_participants=min_participants_text
-        )
+        missing_count = santa.get_missing_count()
+        if missing_count > 0:
+            min_participants_text = f". Other <b>{missing_count}</b> people are needed to start it"
+
+        text = f'{Emoji.SANTA} Oh-oh! A new Secret Santa!\nParticipants list:\n\n{participants_list}\n\n' \
+               f'To join, use the "<b>join</b>" button below and then tap on "<b>start </b>".\n' \
+               f'Only {santa.creator_name_escaped} can start this Secret Santa{min_participants_text}'
 
         reply_markup = keyboards.secret_santa(
             santa.chat_id,
@@ -338,9 +446,17 @@ def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
         logger.error("exception while editing secret santa message (%d, %d): %s", santa.chat_id, santa.santa_message_id, str(e))
         return
 
+    santa.message_hash = message_hash
+
     return edited_message
 
 
+def schedule_santa_expiration(santa: SecretSanta):
+    expires_on = santa.created_on + datetime.timedelta(days=config.santa.timeout)
+    with santas_expiry_heap_lock:
+        heapq.heappush(santas_expiry_heap, (expires_on, santa.chat_id))
+
+
 def create_new_secret_santa(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
     if santa:
         text_message_exists = f"👆 There is already an <a href=\"{santa.link()}\">active Secret Santa</a> in " \
@@ -384,6 +500,7 @@ def create_new_secret_santa(update: Update, context: CallbackContext, santa: Opt
         santa_message_id = sent_message.message_id
 
     new_secret_santa.santa_message_id = santa_message_id
+    schedule_santa_expiration(new_secret_santa)
 
     return new_secret_santa
 
@@ -413,24 +530,24 @@ def on_new_secret_santa_button(update: Update, context: CallbackContext, santa:
 
 
 def find_key(dispatcher_user_data: dict, target_chat_id: int, key_to_find: Union[int, str]) -> bool:
-    for chat_data_chat_id, chat_data in dispatcher_user_data.items():
-        if chat_data_chat_id != target_chat_id:
-            continue
+    chat_data = dispatcher_user_data.get(target_chat_id)
+    if chat_data is None:
+        return False
 
-        return key_to_find in chat_data
+    return key_to_find in chat_data
 
 
 def find_santa_by_chat_id(dispatcher_chat_data: dict, santa_chat_id: int):
-    for chat_data_chat_id, chat_data in dispatcher_chat_data.items():
-        if chat_data_chat_id != santa_chat_id:
-            continue
+    chat_data = dispatcher_chat_data.get(santa_chat_id)
+    if chat_data is None:
+        return
 
-        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
-            logger.debug("chat_data for chat %d exists, but there is no active secret santa", santa_chat_id)
-            return
+    if ACTIVE_SECRET_SANTA_KEY not in chat_data:
+        logger.debug("chat_data for chat %d exists, but there is no active secret santa", santa_chat_id)
+        return
 
-        santa_dict = chat_data[ACTIVE_SECRET_SANTA_KEY]
-        return SecretSanta.from_dict(santa_dict)
+    santa_dict = chat_data[ACTIVE_SECRET_SANTA_KEY]
+    return SecretSanta.from_dict(santa_dict)
 
 
 @fail_with_message()
@@ -438,6 +555,11 @@ def on_join_deeplink(update: Update, context: CallbackContext):
     santa_chat_id = int(context.matches[0].group(1))
     logger.info("join deeplink from %d, chat id: %d", update.effective_user.id, santa_chat_id)
 
+    with santa_lock(santa_chat_id):
+        join_secret_santa(update, context, santa_chat_id)
+
+
+def join_secret_santa(update: Update, context: CallbackContext, santa_chat_id: int):
     if find_key(context.dispatcher.chat_data, santa_chat_id, MUTED_KEY):
         update.message.reply_html(f"It looks like I can't send messages in that group. I can't let "
                                   f"new participants join until I can send messages there, I'm sorry {Emoji.SAD}")
@@ -448,7 +570,7 @@ def on_join_deeplink(update: Update, context: CallbackContext):
         # this might happen if the bot was removed from the group: the "join" button is still there
         # we should check if the chat is in the recently left chats in context.bot_data
         if RECENTLY_LEFT_KEY in context.bot_data and santa_chat_id in context.bot_data[RECENTLY_LEFT_KEY]:
-            logger.debug(f"no active santa in {santa_chat_id} and the chat appears among the recently left chats")
+            logger.debug("no active santa in %d and the chat appears among the recently left chats", santa_chat_id)
             update.message.reply_html(f"It looks like I've been removed from this Secret Santa's group {Emoji.SAD}")
         else:
             # raise ValueError(f"user tried to join, but no secret santa is active in {santa_chat_id}")
@@ -457,7 +579,7 @@ def on_join_deeplink(update: Update, context: CallbackContext):
             # doesn't appear in the recently left groups), and an user uses the old "join" button from an
             # old secret santa
 
-            logger.debug(f"no active santa in {santa_chat_id}")
+            logger.debug("no active santa in %d", santa_chat_id)
             update.message.reply_html(f"It looks like there's no active Secret Santa in this group {Emoji.SAD} "
                                       f"you probably used a \"<b>join</b>\" button from an old/inactive Secret Santa")
         return
@@ -476,8 +598,6 @@ def on_join_deeplink(update: Update, context: CallbackContext):
     duplicate_name = santa.is_duplicate_name(update.effective_user.first_name)
     santa.add(update.effective_user)
 
-    context.dispatcher.chat_data[santa_chat_id][ACTIVE_SECRET_SANTA_KEY] = santa.dict()
-
     if santa.creator_id == update.effective_user.id:
         wait_for_start_text = f"\nYou can start it anytime using the \"<b>start match</b>\" button in the group, " \
                               f"once at least {config.santa.min_participants} people have joined"
@@ -508,6 +628,11 @@ def on_join_deeplink(update: Update, context: CallbackContext):
 def on_leave_button_group(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
     logger.debug("leave button in group: %d -> %d", update.effective_user.id, update.effective_chat.id)
 
+    if not santa:
+        # eg. the secret santa has been started by an update processed while this one was waiting for the santa's lock
+        update.callback_query.answer("This Secret Santa is no longer active", show_alert=True)
+        return
+
     if not santa.is_participant(update.effective_user):
         update.callback_query.answer(f"{Emoji.FREEZE} You haven't joined this Secret Santa!", show_alert=True)
         return
@@ -526,6 +651,36 @@ def on_leave_button_group(update: Update, context: CallbackContext, santa: Optio
     return santa
 
 
+def can_reach_user(bot: Bot, user_id: int) -> bool:
+    requests_rate_limiter.acquire()
+    try:
+        bot.send_chat_action(user_id, ChatAction.TYPING)
+    except (TelegramError, BadRequest) as e:
+        if Error.USER_BLOCKED_BOT in str(e).lower():
+            logger.debug("%d blocked the bot", user_id)
+        else:
+            # what to do?
+            logger.warning("can't send chat action to %d: %s", user_id, str(e))
+
+        return False
+
+    return True
+
+
+def send_match(bot: Bot, santa: SecretSanta, santa_id: int):
+    present_receiver_mention = santa.user_mention_escaped(santa.get_user_receiver_id(santa_id))
+
+    text = f"{Emoji.SANTA}{Emoji.PRESENT} You are {present_receiver_mention}'s <a href=\"{santa.link()}\">Secret Santa</a>!"
+
+    requests_rate_limiter.acquire()
+    try:
+        return bot.send_message(santa_id, text)
+    except (TelegramError, BadRequest) as e:
+        # eg. the user blocked the bot after the reachability check: the other matches are being sent anyway
+        logger.error("error while sending match to %d: %s", santa_id, e)
+        return None
+
+
 def save_recently_started_santa(bot_data: dict, santa: SecretSanta):
     chat_id = santa.chat_id
 
@@ -542,6 +697,12 @@ def save_recently_started_santa(bot_data: dict, santa: SecretSanta):
 @get_secret_santa()
 def on_match_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
     logger.debug("start match button: %d -> %d", update.effective_user.id, update.effective_chat.id)
+
+    if not santa:
+        # eg. the secret santa has been started by an update processed while this one was waiting for the santa's lock
+        update.callback_query.answer("This Secret Santa is no longer active", show_alert=True)
+        return
+
     if santa.creator_id != update.effective_user.id:
         update.callback_query.answer(
             f"{Emoji.CROSS} Only {santa.creator_name} can use this button and start the Secret Santa match",
@@ -556,17 +717,13 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
 
     sent_message = update.effective_message.reply_html(f'{Emoji.HOURGLASS} <i>Matching users...</i>')
 
-    blocked_by = []
-    for user_id, user_data in santa.participants.items():
-        try:
-            context.bot.send_chat_action(user_id, ChatAction.TYPING)
-        except (TelegramError, BadRequest) as e:
-            if Error.USER_BLOCKED_BOT in str(e).lower():
-                logger.debug("%d blocked the bot", user_id)
-            else:
-                # what to do?
-                logger.warning("can't send chat action to %d: %s", user_id, str(e))
+    # check all the participants at the same time instead of waiting for each request to complete
+    participants = list(santa.participants.items())
+    reachable = requests_executor.map(lambda participant: can_reach_user(context.bot, participant[0]), participants)
 
+    blocked_by = []
+    for (user_id, user_data), user_reachable in zip(participants, reachable):
+        if not user_reachable:
             blocked_by.append(utilities.mention_escaped_by_id(user_id, user_data["name"]))
 
     if blocked_by:
@@ -576,38 +733,35 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
         sent_message.edit_text(text)
         return
 
-    matches = []
-    max_attempts = 12
-    failed_attempts = 0
-    while failed_attempts < max_attempts:
-        try:
-            matches = utilities.draft(list(santa.participants.keys()))
-            break
-        except (utilities.TooManyInvalidPicks, utilities.StuckOnLastItem) as e:
-            failed_attempts += 1
-            logger.warning("drafting pairs error: %s (failed attempt %d/%d)", str(e), failed_attempts, max_attempts)
-
-    if not matches:
-        logger.error("match list still empty (failed attempts: %d/%d)", failed_attempts, max_attempts)
-
-        utilities.log_tg(context.bot, f"#drafting_error while generating pairs for chat {update.effective_chat.id}")
-
-        text = f"{Emoji.WARN} <i>{update.effective_user.mention_html()}, " \
-               f"something went wrong during the Secret Santa draw. Please try again</i>"
-        sent_message.edit_text(text)
-        return
-
-    logger.debug("gathered pairs matches, failed attempts: %d", failed_attempts)
+    if config.santa.get('uniform_draft', False):
+        matches = utilities.draft_uniform(list(santa.participants.keys()))
+    else:
+        matches = utilities.draft(list(santa.participants.keys()))
+    logger.debug("gathered pairs matches")
 
+    # save the draw, so matches that can't be delivered now can be sent again later (on_resend_match_button)
     for santa_id, present_receiver_id in matches:
-        present_receiver_name = santa.get_user_name(present_receiver_id)
-        present_receiver_mention = utilities.mention_escaped_by_id(present_receiver_id, present_receiver_name)
+        santa.set_user_receiver_id(santa_id, present_receiver_id)
 
-        text = f"{Emoji.SANTA}{Emoji.PRESENT} You are {present_receiver_mention}'s <a href=\"{santa.link()}\">Secret Santa</a>!"
+    # send all the matches concurrently, without exceeding the bot-wide rate limit
+    santa_ids = [santa_id for santa_id, _ in matches]
+    match_messages = requests_executor.map(lambda santa_id: send_match(context.bot, santa, santa_id), santa_ids)
 
-        match_message = context.bot.send_message(santa_id, text)
-        santa.set_user_match_message_id(santa_id, match_message.message_id)
+    not_delivered_to = []
+    for santa_id, match_message in zip(santa_ids, match_messages):
+        if match_message:
+            santa.set_user_match_message_id(santa_id, match_message.message_id)
+        else:
+            not_delivered_to.append(utilities.mention_escaped_by_id(santa_id, santa.get_user_name(santa_id)))
+
+    if len(not_delivered_to) == len(matches):
+        # nobody received a match: the secret santa can be started again
+        sent_message.edit_text(f"I couldn't send the matches, please try again later {Emoji.SAD}")
+        return
 
+    # some matches have been delivered: the secret santa is started anyway, otherwise using the button again
+    # would send those users a second, different match. Users who didn't receive theirs can get it with
+    # the "get your match" button
     santa.start()  # doesn't do anything beside populating some datetimes
 
     logger.debug("removing active secret santa from chat_data and saving a copy in bot_data...")
@@ -615,12 +769,63 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
 
     save_recently_started_santa(context.bot_data, santa)
 
-    text = f"Everyone has received their match in their <a href=\"{BOT_LINK}\">private chats</a>!"
-    sent_message.edit_text(text)
+    if not_delivered_to:
+        users_list = ", ".join(not_delivered_to)
+        text = f"Everyone has received their match in their <a href=\"{BOT_LINK}\">private chats</a>, except " \
+               f"{users_list}: I couldn't send them their match {Emoji.SAD}\n" \
+               f"They can use the button below to receive it, once they make sure they haven't blocked me"
+        sent_message.edit_text(text, reply_markup=keyboards.resend_match(santa.santa_message_id))
+    else:
+        text = f"Everyone has received their match in their <a href=\"{BOT_LINK}\">private chats</a>!"
+        sent_message.edit_text(text)
 
     update_secret_santa_message(context, santa)
 
 
+@fail_with_message(answer_to_message=False)
+@bot_restricted_check()
+def on_resend_match_button(update: Update, context: CallbackContext):
+    logger.debug("resend match button: %d -> %d", update.effective_user.id, update.effective_chat.id)
+
+    chat_id = update.effective_chat.id
+    santa_message_id = int(update.callback_query.data.rpartition(":")[2])
+
+    with santa_lock(chat_id):
+        santa_dict = context.bot_data.get(RECENTLY_STARTED_SANTAS_KEY, {}).get(chat_id, {}).get(santa_message_id)
+        if not santa_dict:
+            # started secret santas are kept in bot_data for two weeks
+            update.callback_query.answer("This Secret Santa is too old, I can't send its matches anymore", show_alert=True)
+            update.callback_query.edit_message_reply_markup(reply_markup=None)
+            return
+
+        santa = SecretSanta.from_dict(santa_dict)
+
+        user_id = update.effective_user.id
+        if not santa.is_participant(user_id):
+            update.callback_query.answer(f"{Emoji.FREEZE} You are not participating in this Secret Santa!", show_alert=True)
+            return
+
+        if santa.get_user_match_message_id(user_id):
+            update.callback_query.answer("You have already received your match in our private chat", show_alert=True)
+            return
+
+        match_message = send_match(context.bot, santa, user_id)
+        if not match_message:
+            update.callback_query.answer(f"I can't send you your match {Emoji.SAD} Make sure you haven't blocked me, "
+                                         f"and try again", show_alert=True)
+            return
+
+        santa.set_user_match_message_id(user_id, match_message.message_id)
+        update.callback_query.answer("Your match has been sent in our private chat!", show_alert=True)
+
+        if all(santa.get_user_match_message_id(participant_id) for participant_id in santa.participants):
+            logger.debug("every participant has now received their match: removing the button")
+            update.callback_query.edit_message_text(
+                f"Everyone has received their match in their <a href=\"{BOT_LINK}\">private chats</a>!",
+                reply_markup=None
+            )
+
+
 @fail_with_message(answer_to_message=False)
 @bot_restricted_check()
 @get_secret_santa()
@@ -734,13 +939,18 @@ def on_cancel_command(update: Update, context: CallbackContext, santa: Optional[
     )
 
 
+def private_button_chat_id(update: Update) -> int:
+    # private chat buttons' callback data is "private:<action>:<chat_id>"
+    return int(update.callback_query.data.rpartition(":")[2])
+
+
 def private_chat_button():
     # MUST be placed after @get_secret_santa()
     def real_decorator(func):
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext, santa: Optional[SecretSanta], *args, **kwargs):
-            santa_chat_id = int(context.matches[0].group(1))
-            logger.debug("private chat button, chat_id: %d", santa_chat_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("private chat button, chat_id: %d", private_button_chat_id(update))
 
             if not santa:
                 # if there is no santa in that chat (has already been started), the user will still be able to
@@ -822,41 +1032,69 @@ def on_supergroup_migration(update: Update, context: CallbackContext):
     if not update.message.migrate_to_chat_id:
         return
 
-    logger.info(f"supergroup migration: {update.effective_chat.id} -> {update.message.migrate_to_chat_id}")
-
     old_chat_id = update.effective_chat.id
     new_chat_id = update.message.migrate_to_chat_id
 
-    if ACTIVE_SECRET_SANTA_KEY not in context.chat_data:
-        return
+    logger.info("supergroup migration: %d -> %d", old_chat_id, new_chat_id)
 
-    logger.debug("old chat_id %d has an ongoing secret santa", old_chat_id)
+    # handlers might be using the old chat's secret santa, or the new chat's data, right now
+    with santa_lock(old_chat_id), santa_lock(new_chat_id):
+        if ACTIVE_SECRET_SANTA_KEY not in context.chat_data:
+            return
 
-    santa_dict = context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY)
-    old_santa = SecretSanta.from_dict(santa_dict)
+        new_chat_data = context.dispatcher.chat_data[new_chat_id]
+        if ACTIVE_SECRET_SANTA_KEY in new_chat_data:
+            # someone already created a new secret santa in the supergroup: don't replace it
+            logger.info("new supergroup %d already has an active secret santa: not migrating the old one", new_chat_id)
+            return
 
-    # the api doesn't allow to delete the old santa message because the old group is no longer available
+        logger.debug("old chat_id %d has an ongoing secret santa", old_chat_id)
 
-    new_secret_santa = SecretSanta(
-        origin_message_id=update.effective_message.message_id,
-        user_id=old_santa.creator_id,
-        user_name=old_santa.creator_name,
-        chat_id=new_chat_id,
-        chat_title=update.effective_chat.title,
-        participants=old_santa.participants
-    )
+        santa_dict = context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY)
+        old_santa = SecretSanta.from_dict(santa_dict)
+
+        # the api doesn't allow to delete the old santa message because the old group is no longer available
 
-    logger.debug("sending new message...")
-    reply_markup = keyboards.secret_santa(new_chat_id, context.bot.username)
-    sent_message = context.bot.send_message(new_chat_id, EMPTY_SECRET_SANTA_STR, reply_markup=reply_markup)
-    new_secret_santa.santa_message_id = sent_message.message_id
+        new_secret_santa = SecretSanta(
+            origin_message_id=update.effective_message.message_id,
+            user_id=old_santa.creator_id,
+            user_name=old_santa.creator_name,
+            chat_id=new_chat_id,
+            chat_title=update.effective_chat.title,
+            participants=old_santa.participants
+        )
+
+        # save the new santa before sending anything, so it's not lost if something goes wrong while
+        # sending/editing the new message
+        logger.debug("saving new chat_data for new supergroup %d...", new_chat_id)
+        new_chat_data[ACTIVE_SECRET_SANTA_KEY] = new_secret_santa.dict()
+        schedule_santa_expiration(new_secret_santa)
+
+    # sending and editing the new message requires two requests: we do that in a job so we don't block the dispatcher
+    logger.debug("scheduling new message job...")
+    context.job_queue.run_once(send_migrated_santa_message, 0, context=new_chat_id)
 
-    logger.debug("saving new chat_data for new supergroup %d...", new_chat_id)
-    context.dispatcher.chat_data[new_chat_id] = {ACTIVE_SECRET_SANTA_KEY: new_secret_santa.dict()}
 
-    # we need to update it as soon as we send it because there might be existing participants to list
-    logger.debug("editing new message...")
-    update_secret_santa_message(context, new_secret_santa)
+@fail_with_message_job
+def send_migrated_santa_message(context: CallbackContext):
+    new_chat_id = context.job.context
+
+    with santa_lock(new_chat_id):
+        chat_data = context.dispatcher.chat_data[new_chat_id]
+        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
+            logger.debug("no secret santa to send for migrated chat %d", new_chat_id)
+            return
+
+        new_secret_santa = SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY])
+
+        logger.debug("sending new message...")
+        reply_markup = keyboards.secret_santa(new_chat_id, context.bot.username)
+        sent_message = context.bot.send_message(new_chat_id, EMPTY_SECRET_SANTA_STR, reply_markup=reply_markup)
+        new_secret_santa.santa_message_id = sent_message.message_id
+
+        # we need to update it as soon as we send it because there might be existing participants to list
+        logger.debug("editing new message...")
+        update_secret_santa_message(context, new_secret_santa)
 
 
 @fail_with_message(answer_to_message=False)
@@ -878,13 +1116,8 @@ def on_new_group_chat(update: Update, context: CallbackContext):
     if not config.santa.start_button_on_new_group:
         return
 
-    text = f"Hello everyone! I'm a bot that helps group chats to organize their " \
-           f"Secret Santas {Emoji.SANTA}{Emoji.SHH}\n" \
-           f"Anyone can use the button below to start a new one. Alternatively, the <code>/newsanta</code> command " \
-           f"can be used"
-
     update.message.reply_html(
-        text,
+        NEW_GROUP_STR,
         reply_markup=keyboards.new_santa(),
         quote=False,
     )
@@ -980,8 +1213,9 @@ def on_my_chat_member_update(update: Update, context: CallbackContext):
 
     if my_chat_member.new_chat_member.status == ChatMember.LEFT:
         # we receive this kind of update also when the group is deleted
-        logger.debug("old_chat_member: %s", my_chat_member.old_chat_member)
-        logger.debug("new_chat_member: %s", my_chat_member.new_chat_member)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("old_chat_member: %s", my_chat_member.old_chat_member)
+            logger.debug("new_chat_member: %s", my_chat_member.new_chat_member)
         logger.info("bot removed from %d, removing chat_data...", my_chat_member.chat.id)
         context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
         context.chat_data.pop(MUTED_KEY, None)
@@ -1015,11 +1249,8 @@ def secret_santa_expired(context: CallbackContext, santa: SecretSanta):
     if not santa.started:
         text = f"<i>This Secret Santa expired ({config.santa.timeout} days has passed from its creation)</i>"
     else:
-        participants_list = gen_participants_list(santa.participants)
-        text = '{hourglass} This Secret Santa has been closed. Participants list:\n\n{participants}'.format(
-            hourglass=Emoji.HOURGLASS,
-            participants="\n".join(participants_list)
-        )
+        participants_list = gen_participants_list(santa.participants, join_by="\n")
+        text = CLOSED_SECRET_SANTA_STR.format(participants=participants_list)
 
     try:
         edited_message = context.bot.edit_message_text(
@@ -1035,28 +1266,55 @@ def secret_santa_expired(context: CallbackContext, santa: SecretSanta):
     return edited_message
 
 
+def close_expired_secret_santa(context: CallbackContext, chat_id: int, now: datetime.datetime):
+    chat_data = context.dispatcher.chat_data.get(chat_id)
+    if not chat_data or ACTIVE_SECRET_SANTA_KEY not in chat_data:
+        # started or canceled in the meantime
+        return
+
+    santa = SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY])
+
+    diff_seconds = (now - santa.created_on).total_seconds()
+    if diff_seconds <= config.santa.timeout * Time.DAY_1:
+        # a new secret santa was created in the meantime: it has its own entry in the heap
+        return
+
+    if MUTED_KEY in chat_data:
+        logger.info("can't edit chat %d's expired santa message: the bot is marked as muted", chat_id)
+    else:
+        secret_santa_expired(context, santa)
+
+    logger.debug("popping secret santa from chat %d", chat_id)
+    chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+
+
 @fail_with_message_job
 def close_old_secret_santas(context: CallbackContext):
     logger.info("inactive secret santa job...")
 
-    for chat_id, chat_data in context.dispatcher.chat_data.items():
-        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
-            continue
-
-        santa = SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY])
+    now = utilities.now()
 
-        now = utilities.now()
-        diff_seconds = (now - santa.created_on).total_seconds()
-        if diff_seconds <= config.santa.timeout * Time.DAY_1:
-            continue
+    expired_entries = []
+    with santas_expiry_heap_lock:
+        while santas_expiry_heap and santas_expiry_heap[0][0] < now:
+            expired_entries.append(heapq.heappop(santas_expiry_heap))
 
-        if MUTED_KEY in chat_data:
-            logger.info("can't edit chat %d's expired santa message: the bot is marked as muted", chat_id)
-        else:
-            secret_santa_expired(context, santa)
+    logger.debug("%d chats with a possibly expired secret santa", len(expired_entries))
+    failed_entries = []
+    for expired_entry in expired_entries:
+        try:
+            with santa_lock(expired_entry[1]):
+                close_expired_secret_santa(context, expired_entry[1], now)
+        except Exception as e:
+            # the entry is no longer in the heap: put it back later, so the next run will try again
+            logger.error("error while closing chat %d's expired secret santa: %s", expired_entry[1], e, exc_info=True)
+            failed_entries.append(expired_entry)
 
-        logger.debug("popping secret santa from chat %d", chat_id)
-        chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+    if failed_entries:
+        logger.info("%d expired secret santas will be processed again during the next run", len(failed_entries))
+        with santas_expiry_heap_lock:
+            for failed_entry in failed_entries:
+                heapq.heappush(santas_expiry_heap, failed_entry)
 
     logger.info("...cleanup job end")
 
@@ -1065,17 +1323,17 @@ def close_old_secret_santas(context: CallbackContext):
 def bot_data_cleanup(context: CallbackContext):
     logger.info("executing job...")
 
+    now = utilities.now()
+
     if RECENTLY_LEFT_KEY in context.bot_data:
         logger.info("cleaning up %s...", RECENTLY_LEFT_KEY)
 
-        chat_ids_to_pop = []
-        for chat_id, left_dt in context.dispatcher.bot_data[RECENTLY_LEFT_KEY].items():
-            now = utilities.now()
-            diff_seconds = (now - left_dt).total_seconds()
-            if diff_seconds <= Time.WEEK_4:
-                continue
-
-            chat_ids_to_pop.append(chat_id)
+        # handlers might edit these dicts while we go through them: iterate over a copy of their items
+        chat_ids_to_pop = [
+            chat_id
+            for chat_id, left_dt in list(context.dispatcher.bot_data[RECENTLY_LEFT_KEY].items())
+            if (now - left_dt).total_seconds() > Time.WEEK_4
+        ]
 
         logger.debug("%d chats to pop", len(chat_ids_to_pop))
         for chat_id in chat_ids_to_pop:
@@ -1087,16 +1345,13 @@ def bot_data_cleanup(context: CallbackContext):
 
         chat_ids_to_pop = []
         logger.debug("currently stored chats: %d", len(context.bot_data[RECENTLY_STARTED_SANTAS_KEY]))
-        for chat_id, chat_santas in context.bot_data[RECENTLY_STARTED_SANTAS_KEY].items():
-            santa_ids_to_pop = []
-            for santa_message_id, santa_dict in chat_santas.items():
-                santa = SecretSanta.from_dict(santa_dict)
-                now = utilities.now()
-                diff_seconds = (now - santa.started_on).total_seconds()
-                if diff_seconds <= Time.WEEK_2:
-                    continue
-
-                santa_ids_to_pop.append(santa_message_id)
+        for chat_id, chat_santas in list(context.bot_data[RECENTLY_STARTED_SANTAS_KEY].items()):
+            # no need to build a SecretSanta object just to read its start date
+            santa_ids_to_pop = [
+                santa_message_id
+                for santa_message_id, santa_dict in list(chat_santas.items())
+                if (now - santa_dict["started_on"]).total_seconds() > Time.WEEK_2
+            ]
 
             logger.debug("%d santa_ids to pop", len(santa_ids_to_pop))
             for santa_id in santa_ids_to_pop:
@@ -1112,48 +1367,96 @@ def bot_data_cleanup(context: CallbackContext):
             logger.debug("popping chat_id %d because its dict is now empty", chat_id)
             context.bot_data[RECENTLY_STARTED_SANTAS_KEY].pop(chat_id, None)
 
+    if ADMIN_IDS_KEY in context.bot_data:
+        logger.info("cleaning up %s...", ADMIN_IDS_KEY)
+
+        # saved administrators are not used after ADMIN_IDS_CACHE_TIMEOUT seconds
+        now_timestamp = time.time()
+        chat_ids_to_pop = [
+            chat_id
+            for chat_id, (fetched_on, _) in list(context.bot_data[ADMIN_IDS_KEY].items())
+            if now_timestamp - fetched_on > ADMIN_IDS_CACHE_TIMEOUT
+        ]
+
+        logger.debug("%d chats to pop", len(chat_ids_to_pop))
+        for chat_id in chat_ids_to_pop:
+            context.bot_data[ADMIN_IDS_KEY].pop(chat_id, None)
+
     logger.info("...job execution end")
 
 
+@fail_with_message_job
+def flush_persistence(context: CallbackContext):
+    logger.debug("flushing persistence...")
+    context.dispatcher.persistence.flush()
+
+
+GROUP_BUTTONS = {
+    "newsanta": on_new_secret_santa_button,
+    "match": on_match_button,
+    "leave": on_leave_button_group,
+    "cancel": on_cancel_button,
+    "revoke": on_revoke_button,
+}
+
+
+def on_group_button(update: Update, context: CallbackContext):
+    callback = GROUP_BUTTONS[update.callback_query.data]
+    return callback(update, context)
+
+
 def main():
     dispatcher = updater.dispatcher
 
+    dispatcher.add_error_handler(on_error)
+
     dispatcher.add_handler(MessageHandler(NewGroup(), on_new_group_chat))
     dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, on_supergroup_migration))
 
     dispatcher.add_handler(CommandHandler(["ongoing"], admin_ongoing_command, filters=Filters.chat_type.private))
 
-    dispatcher.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/start (-?\d+)"), on_join_deeplink))
+    dispatcher.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(JOIN_DEEPLINK_REGEX), on_join_deeplink))
     dispatcher.add_handler(CommandHandler(["start", "help"], on_help, filters=Filters.chat_type.private))
 
-    dispatcher.add_handler(CommandHandler(["new", "newsanta", "santa"], on_new_secret_santa_command, filters=Filters.chat_type.groups))
-    dispatcher.add_handler(CommandHandler(["cancel"], on_cancel_command, filters=Filters.chat_type.groups))
-    dispatcher.add_handler(CommandHandler(["hidecommands"], on_hide_commands_command, filters=Filters.chat_type.groups))
-    dispatcher.add_handler(CommandHandler(["showcommands"], on_show_commands_command, filters=Filters.chat_type.groups))
+    group_chat = GroupChat()
+    dispatcher.add_handler(CommandHandler(["new", "newsanta", "santa"], on_new_secret_santa_command, filters=group_chat))
+    dispatcher.add_handler(CommandHandler(["cancel"], on_cancel_command, filters=group_chat))
+    dispatcher.add_handler(CommandHandler(["hidecommands"], on_hide_commands_command, filters=group_chat))
+    dispatcher.add_handler(CommandHandler(["showcommands"], on_show_commands_command, filters=group_chat))
 
-    dispatcher.add_handler(CallbackQueryHandler(on_new_secret_santa_button, pattern=r'^newsanta$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_match_button, pattern=r'^match$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_leave_button_group, pattern=r'^leave$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_cancel_button, pattern=r'^cancel$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_revoke_button, pattern=r'^revoke$'))
+    # callable patterns receive the callback data: plain string checks are enough to route our own buttons
+    dispatcher.add_handler(CallbackQueryHandler(on_group_button, pattern=lambda data: data in GROUP_BUTTONS))
+    dispatcher.add_handler(CallbackQueryHandler(on_resend_match_button, pattern=lambda data: data.startswith("resendmatch:")))
 
-    dispatcher.add_handler(CallbackQueryHandler(on_leave_button_private, pattern=r'^private:leave:(-\d+)$'))
-    dispatcher.add_handler(CallbackQueryHandler(on_update_name_button_private, pattern=r'^private:updatename:(-\d+)$'))
+    dispatcher.add_handler(CallbackQueryHandler(on_leave_button_private, pattern=lambda data: data.startswith("private:leave:")))
+    dispatcher.add_handler(CallbackQueryHandler(on_update_name_button_private, pattern=lambda data: data.startswith("private:updatename:")))
 
     dispatcher.add_handler(ChatMemberHandler(on_my_chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
 
+    for chat_id, chat_data in dispatcher.chat_data.items():
+        if ACTIVE_SECRET_SANTA_KEY in chat_data:
+            schedule_santa_expiration(SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY]))
+
     updater.job_queue.run_repeating(close_old_secret_santas, interval=Time.HOUR_6, first=Time.MINUTE_30)
     updater.job_queue.run_repeating(bot_data_cleanup, interval=Time.DAY_1, first=Time.HOUR_6)
-
-    updater.bot.set_my_commands([])  # make sure the bot doesn't have any command set...
-    updater.bot.set_my_commands(  # ...then set the scope for private chats
-        commands=Commands.PRIVATE,
-        scope=BotCommandScopeAllPrivateChats()
-    )
-    updater.bot.set_my_commands(  # ...then set the scope for group administrators
-        commands=Commands.GROUP_ADMINISTRATORS,
-        scope=BotCommandScopeAllChatAdministrators()
-    )
+    updater.job_queue.run_repeating(flush_persistence, interval=Time.MINUTE_1, first=Time.MINUTE_1)
+
+    # the three scopes are independent from each other, so we can set them at the same time
+    commands_requests = [
+        requests_executor.submit(updater.bot.set_my_commands, []),  # make sure the bot doesn't have any default command...
+        requests_executor.submit(  # ...set the scope for private chats...
+            updater.bot.set_my_commands,
+            commands=Commands.PRIVATE,
+            scope=BotCommandScopeAllPrivateChats()
+        ),
+        requests_executor.submit(  # ...and the scope for group administrators
+            updater.bot.set_my_commands,
+            commands=Commands.GROUP_ADMINISTRATORS,
+            scope=BotCommandScopeAllChatAdministrators()
+        ),
+    ]
+    for commands_request in commands_requests:
+        commands_request.result()  # raises the request's exception, if any
 
     allowed_updates = ["message", "callback_query", "my_chat_member"]  # https://core.telegram.org/bots/api#getupdates
 
@@ -1161,6 +1464,8 @@ def main():
     updater.start_polling(drop_pending_updates=True, allowed_updates=allowed_updates)
     updater.idle()
 
+    requests_executor.shutdown()
+
 
 if __name__ == '__main__':
     main()
@@ -21,6 +21,8 @@ def update_time(func):
 
 
 class SecretSanta:
+    __slots__ = ("_santa_dict",)
+
     def __init__(
             self,
             origin_message_id: int,
@@ -34,37 +36,48 @@ class SecretSanta:
             updated_on: Optional[datetime.datetime] = None,
             started: bool = False,
             started_on: Optional[datetime.datetime] = None,
+            message_hash: Optional[str] = None,
     ):
-        now = utilities.now()
+        if created_on is None or updated_on is None:
+            now = utilities.now()
+            created_on = created_on or now
+            updated_on = updated_on or now
+
         self._santa_dict = {
             "origin_message_id": origin_message_id,  # message received from the user in the group
             "santa_message_id": santa_message_id,  # message we send in the group
-            "participants": participants or {},
-            "created_on": created_on or now,
-            "updated_on": updated_on or now,
+            # an empty participants dict must be kept as it is: it's the one stored in chat_data
+            "participants": participants if participants is not None else {},
+            "created_on": created_on,
+            "updated_on": updated_on,
             "user_id": user_id,
             "user_name": user_name,
+            "user_name_escaped": utilities.html_escape(user_name),
             "chat_id": chat_id,
             "chat_title": chat_title,
+            "chat_title_escaped": utilities.html_escape(chat_title),
             "started": started,
             "started_on": started_on,
+            "message_hash": message_hash,  # hash of the state santa_message_id was last rendered from
         }
 
     @classmethod
     def from_dict(cls, santa_dict: dict):
-        return cls(
-            origin_message_id=santa_dict["origin_message_id"],
-            user_id=santa_dict["user_id"],
-            user_name=santa_dict["user_name"],
-            chat_id=santa_dict["chat_id"],
-            chat_title=santa_dict["chat_title"],
-            santa_message_id=santa_dict["santa_message_id"],
-            participants=santa_dict["participants"],
-            created_on=santa_dict["created_on"],
-            updated_on=santa_dict["updated_on"],
-            started=santa_dict["started"],
-            started_on=santa_dict.get("started_on", None),
-        )
+        # the returned object is a view over santa_dict (which is usually stored in chat_data/bot_data): there's
+        # no need to save it back after it's been modified
+
+        # keys added after the first version
+        santa_dict.setdefault("started_on", None)
+        santa_dict.setdefault("message_hash", None)
+        if "user_name_escaped" not in santa_dict:
+            santa_dict["user_name_escaped"] = utilities.html_escape(santa_dict["user_name"])
+        if "chat_title_escaped" not in santa_dict:
+            santa_dict["chat_title_escaped"] = utilities.html_escape(santa_dict["chat_title"])
+
+        santa = cls.__new__(cls)
+        santa._santa_dict = santa_dict
+
+        return santa
 
     def dict(self):
         return self._santa_dict
@@ -79,7 +92,7 @@ class SecretSanta:
 
     @property
     def creator_name_escaped(self):
-        return utilities.html_escape(self.creator_name)
+        return self._santa_dict["user_name_escaped"]
 
     @property
     def chat_id(self):
@@ -91,7 +104,7 @@ class SecretSanta:
 
     @property
     def chat_title_escaped(self):
-        return utilities.html_escape(self.chat_title)
+        return self._santa_dict["chat_title_escaped"]
 
     @property
     def origin_message_id(self):
@@ -121,6 +134,14 @@ class SecretSanta:
     def started_on(self, new_value):
         self._santa_dict["started_on"] = new_value
 
+    @property
+    def message_hash(self):
+        return self._santa_dict["message_hash"]
+
+    @message_hash.setter
+    def message_hash(self, new_value):
+        self._santa_dict["message_hash"] = new_value
+
     @property
     def message_id(self):
         return self.santa_message_id
@@ -139,10 +160,8 @@ class SecretSanta:
 
     @staticmethod
     def user_id(user_id: Union[int, User]):
-        if isinstance(user_id, User):
-            return user_id.id
-
-        return user_id
+        # ints don't have an "id" attribute
+        return getattr(user_id, "id", user_id)
 
     @property
     def created_on(self):
@@ -160,17 +179,14 @@ class SecretSanta:
             user: User,
             match_message_id: Optional[int] = None,
             join_message_id: Optional[int] = None,
-    ) -> bool:
-        already_a_participant = user.id in self.participants
-
+    ):
         self._santa_dict["participants"][user.id] = {
             "name": user.first_name[:NAME_MAX_LENGTH],
             "match_message_id": match_message_id,
-            "last_join_message_id": join_message_id
+            "last_join_message_id": join_message_id,
+            "receiver_id": None,
         }
 
-        return already_a_participant
-
     # @update_time
     def update_user_name(self, user: Union[User, str]):
         name = user
@@ -217,6 +233,15 @@ class SecretSanta:
         user_id = self.user_id(user)
         self._santa_dict["participants"][user_id]["match_message_id"] = message_id
 
+    def get_user_receiver_id(self, user: Union[int, User]) -> Optional[int]:
+        user_id = self.user_id(user)
+        # participants added before this key existed don't have it
+        return self._santa_dict["participants"][user_id].get("receiver_id")
+
+    def set_user_receiver_id(self, user: Union[int, User], receiver_id: int):
+        user_id = self.user_id(user)
+        self._santa_dict["participants"][user_id]["receiver_id"] = receiver_id
+
     def get_user_join_message_id(self, user: Union[int, User]) -> int:
         user_id = self.user_id(user)
         # noinspection PyTypeChecker
@@ -1,9 +1,12 @@
 import datetime
+import gc
 import logging
 import os
 import pickle
 import random
-import re
+import threading
+import time
+from collections import defaultdict, deque
 from html import escape
 from typing import Union, List
 
@@ -17,6 +20,9 @@ from config import config
 
 logger = logging.getLogger(__name__)
 
+# supergroup ids are "-100" followed by the id used in t.me/c/ links, eg. -1001234567890
+SUPERGROUP_ID_OFFSET = 10 ** 12
+
 
 def now_utc():
     return datetime.datetime.utcnow()
@@ -26,8 +32,8 @@ def now():
     return datetime.datetime.now()
 
 
-def html_escape(string: str):
-    return escape(string)
+# alias instead of a wrapper function: saves a call on every escape
+html_escape = escape
 
 
 def mention_escaped(user: User, label="", full_name=False):
@@ -42,27 +48,31 @@ def mention_escaped_by_id(user_id: int, name: str):
 
 
 def first_dict_item(origin_dict: dict):
-    for _, val in origin_dict.items():
-        return val
+    return next(iter(origin_dict.values()), None)
 
 
 def is_supergroup(chat: Union[Chat, int]):
-    chat_id = chat
-    if isinstance(chat, Chat):
-        chat_id = chat.id
+    chat_id = chat.id if isinstance(chat, Chat) else chat
 
-    return str(chat_id).startswith("-100")
+    # supergroup ids are "-100" followed by ten digits, other chats have shorter ids
+    return -SUPERGROUP_ID_OFFSET * 10 < chat_id <= -SUPERGROUP_ID_OFFSET
 
 
 def chat_id_link(chat_id: int):
-    return int(re.sub(r"^-?100", "", str(chat_id)))
+    if chat_id <= -SUPERGROUP_ID_OFFSET:
+        return -chat_id - SUPERGROUP_ID_OFFSET
+
+    return abs(chat_id)
 
 
 def message_link(chat: Union[Chat, int], message_id: int, force_private=False):
-    chat_id = chat.id if isinstance(chat, Chat) else chat
+    if isinstance(chat, Chat):
+        if not force_private and chat.username:
+            return f"https://t.me/{chat.username}/{message_id}"
 
-    if isinstance(chat, Chat) and not force_private and chat.username:
-        return f"https://t.me/{chat.username}/{message_id}"
+        chat_id = chat.id
+    else:
+        chat_id = chat
 
     return f"https://t.me/c/{chat_id_link(chat_id)}/{message_id}"
 
@@ -83,49 +93,63 @@ def safe_delete_by_id(bot: Bot, chat_id: int, message_id: int, log_error=True):
         return True
     except Exception as e:
         if log_error:
-            logger.error("error while deleting message %d from chat %d: %s", message_id, chat_id, str(e))
+            logger.error("error while deleting message %d from chat %d: %s", message_id, chat_id, e)
         return False
 
 
 def log_tg(bot: Bot, text: str):
-    if not config.telegram.log_chat:
+    log_chat = config.telegram.log_chat
+    if not log_chat:
         logger.debug("can't log to Telegram: no log chat configured")
         return
 
     text = f"#{bot.username} warning: {text}"
 
     try:
-        bot.send_message(config.telegram.log_chat, text)
+        bot.send_message(log_chat, text)
     except (BadRequest, TelegramError) as e:
-        logger.warning("exception while logging message to chat %d: %s", config.telegram.log_chat, str(e))
+        logger.warning("exception while logging message to chat %d: %s", log_chat, e)
         logger.debug("trying again with parse_mode disabled...")
-        bot.send_message(config.telegram.log_chat, text, parse_mode=None)
+        bot.send_message(log_chat, text, parse_mode=None)
 
 
-class TooManyInvalidPicks(Exception):
-    pass
+class RateLimiter:
+    """Blocks the caller until less than `max_calls` calls have been made in the last `period` seconds"""
 
+    def __init__(self, max_calls: int, period: float = 1.0):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
 
-class StuckOnLastItem(Exception):
-    pass
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
 
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
 
-def draft(items_list: list, max_invalid_picks: int = 300):
+                time.sleep(self.period - (now - self._calls[0]))
+
+
+def draft(items_list: list):
     # logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
     logger = logging.getLogger("draft")
 
-    random.shuffle(items_list)
-
+    # Sattolo's algorithm: a uniformly random permutation made of a single cycle, in one pass and
+    # with no retries. Nobody is matched with themselves, and there are no closed sub-groups
     items_count = len(items_list)
-    result_pairs = []  # [(santa, receiver), (santa, receiver)...]
-    for i, name in enumerate(items_list):
-        santa = i
-        receiver = i + 1
-        if receiver == items_count:
-            # the last santa gifts the first in the list
-            receiver = 0
+    receivers = list(range(items_count))
+    for i in reversed(range(1, items_count)):
+        j = random.randrange(i)
+        receivers[i], receivers[j] = receivers[j], receivers[i]
 
-        result_pairs.append((items_list[santa], items_list[receiver]))
+    # [(santa, receiver), (santa, receiver)...]
+    result_pairs = [(items_list[santa], items_list[receiver]) for santa, receiver in enumerate(receivers)]
 
     logger.debug("%s", items_list)
     logger.debug("%s", result_pairs)
@@ -133,24 +157,149 @@ def draft(items_list: list, max_invalid_picks: int = 300):
     return result_pairs
 
 
-def persistence_object(file_path='persistence/data.pickle'):
-    logger.info('unpickling persistence: %s', file_path)
-    try:
-        # try to load the file
+def draft_uniform(items_list: list):
+    logger = logging.getLogger("draft")
+
+    # uniformly random derangement: Fisher-Yates shuffle that restarts as soon as someone would be matched
+    # with themselves (~2.7 attempts on average). Unlike draft(), pairs might form smaller closed groups
+    items_count = len(items_list)
+    if items_count < 2:
+        raise ValueError("at least two items are needed for a derangement")
+
+    attempts = 0
+    while True:
+        attempts += 1
+        receivers = list(range(items_count))
+        for i in reversed(range(1, items_count)):
+            j = random.randrange(i + 1)
+            if receivers[j] == i:
+                break
+
+            receivers[i], receivers[j] = receivers[j], receivers[i]
+        else:
+            if receivers[0] != 0:
+                break
+
+    # [(santa, receiver), (santa, receiver)...]
+    result_pairs = [(items_list[santa], items_list[receiver]) for santa, receiver in enumerate(receivers)]
+
+    logger.debug("attempts: %d", attempts)
+    logger.debug("%s", result_pairs)
+
+    return result_pairs
+
+
+class SafePicklePersistence(PicklePersistence):
+    # we load and dump the file ourselves instead of relying on PicklePersistence's private helpers, so we can
+    # recover from a broken file and use the fastest pickle protocol
+
+    FLUSH_ATTEMPTS = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaded = False
+        self._flush_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # the file is unpickled once, here. PicklePersistence's getters load the file again every time the data
+        # they return is empty, so we override them to check self._loaded instead
+        data = {}
         try:
-            with open(file_path, "rb") as f:
-                pickle.load(f)
+            with open(self.filename, "rb") as f:
+                # files written with protocol 2+ start with the PROTO opcode: if it's missing (or the file is empty),
+                # we don't even try to unpickle it
+                if f.read(1) != pickle.PROTO:
+                    raise pickle.UnpicklingError("the file is empty or is not a pickle file")
+
+                f.seek(0)
+
+                # unpickling creates lots of objects: avoid the garbage collector running over and over
+                # while the data is being loaded
+                gc.disable()
+                try:
+                    data = pickle.load(f)
+                finally:
+                    gc.enable()
         except FileNotFoundError:
             pass
-    except (pickle.UnpicklingError, EOFError):
-        logger.warning('deserialization failed: removing persistence file and trying again')
-        os.remove(file_path)
+        except (pickle.UnpicklingError, EOFError) as e:
+            # only for corrupted files: any other error (eg. a class that can't be imported anymore) is raised,
+            # otherwise the flush job would replace the file with empty data.
+            # Keep the broken file around, so it can be inspected
+            broken_file_path = f"{self.filename}.{time.strftime('%Y%m%d-%H%M%S')}.broken"
+            logger.warning('deserialization failed (%s): moving persistence file to %s and starting from scratch', str(e), broken_file_path)
+            os.replace(self.filename, broken_file_path)
+
+        self.user_data = defaultdict(dict, data.get('user_data', {}))
+        self.chat_data = defaultdict(dict, data.get('chat_data', {}))
+        self.bot_data = data.get('bot_data', {})
+        self.callback_data = data.get('callback_data', {}) if data else None
+        self.conversations = data.get('conversations', {})
+        self._loaded = True
+
+    def get_user_data(self):
+        if not self._loaded:
+            self.load()
+
+        return self.user_data
+
+    def get_chat_data(self):
+        if not self._loaded:
+            self.load()
+
+        return self.chat_data
+
+    def get_bot_data(self):
+        if not self._loaded:
+            self.load()
+
+        return self.bot_data
+
+    def flush(self):
+        data = {
+            'conversations': self.conversations,
+            'user_data': self.user_data,
+            'chat_data': self.chat_data,
+            'bot_data': self.bot_data,
+            'callback_data': self.callback_data,
+        }
+
+        # handlers keep editing the data while we pickle it: dump it in memory first, and try again if a dict
+        # changed size while it was being pickled
+        for attempt in range(1, self.FLUSH_ATTEMPTS + 1):
+            try:
+                pickled_data = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+                break
+            except RuntimeError as e:
+                if attempt == self.FLUSH_ATTEMPTS:
+                    raise
+
+                logger.warning('data changed while pickling it (%s), trying again...', e)
+
+        # write a temporary file and then replace the old one, so if something goes wrong while writing
+        # we still have the last complete file
+        tmp_file_path = f"{self.filename}.tmp"
+        with self._flush_lock:
+            with open(tmp_file_path, "wb") as f:
+                f.write(pickled_data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_file_path, self.filename)
+
+
+def persistence_object(file_path='persistence/data.pickle'):
+    logger.info('unpickling persistence: %s', file_path)
 
-    return PicklePersistence(
+    return SafePicklePersistence(
         filename=file_path,
         store_chat_data=True,
         store_user_data=True,
-        store_bot_data=True
+        store_bot_data=True,
+        # by default, the whole file is written every time some data changes. We only write it when flush() is
+        # called: periodically by a job, and when the bot is stopped
+        on_flush=True
     )
 
 